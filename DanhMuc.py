@@ -3,9 +3,11 @@ import pandas as pd
 import json
 import os
 import base64
+import requests
 from pathlib import Path
 from datetime import datetime, date
-from vnstock import Quote, Listing
+
+import vci
 
 # ============================================================
 # CẤU HÌNH TRANG
@@ -324,18 +326,18 @@ def save_closed(data):
 
 
 # ============================================================
-# LẤY GIÁ THỊ TRƯỜNG TỪ VNSTOCK
+# LẤY GIÁ THỊ TRƯỜNG TỪ VCI (logic chung nằm trong vci.py)
 # ============================================================
 @st.cache_data(ttl=300, show_spinner=False)
 def get_market_price(symbol: str) -> float | None:
     """Lấy giá đóng cửa mới nhất của 1 mã cổ phiếu (đơn vị: VND)."""
     try:
-        quote = Quote(symbol=symbol, source='VCI')
-        df = quote.history(length="1M", interval="1D")
-        if df is not None and not df.empty:
-            # vnstock trả giá theo đơn vị nghìn VND (VD: 92.6 = 92,600 VND)
-            raw_price = float(df["close"].iloc[-1])
-            return raw_price * 1000
+        resp = requests.post(vci.VCI_CHART_URL, json=vci.history_payload([symbol]),
+                             headers=vci.VCI_HEADERS, timeout=10)
+        resp.raise_for_status()
+        parsed = vci.parse_closes(resp.json())
+        if symbol in parsed:
+            return parsed[symbol][0]
     except Exception:
         pass
     return None
@@ -344,14 +346,7 @@ def get_market_price(symbol: str) -> float | None:
 @st.cache_data(ttl=86400, show_spinner=False)
 def get_industry_map() -> dict:
     """Lấy bảng phân ngành ICB cấp 2 cho tất cả mã CP (cache 1 ngày)."""
-    try:
-        ls = Listing()
-        df = ls.symbols_by_industries()
-        if df is not None and not df.empty:
-            return dict(zip(df["symbol"], df["industry_name"]))
-    except Exception:
-        pass
-    return {}
+    return vci.fetch_industry_map()
 
 
 # ============================================================
@@ -4,18 +4,44 @@ Lấy giá đóng cửa mới nhất + phân ngành cho các mã CP trong stocks
 lưu vào prices.json để trang HTML đọc.
 """
 
+import asyncio
 import json
 import os
+import random
 import sys
 import time
-from datetime import datetime, timezone, timedelta
-from vnstock import Listing, Quote
+from collections import deque
+from datetime import datetime
+
+import httpx
+import orjson
 from supabase import create_client, Client
 
-VN_TZ = timezone(timedelta(hours=7))
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))  # vci.py nằm ở thư mục gốc repo
+import vci
+from vci import VN_TZ
+
 OUTPUT_FILE = os.path.join(SCRIPT_DIR, "prices.json")
 
+MAX_CONCURRENCY = 10  # trần số request đồng thời tới VCI
+CHUNK_SIZE = 100  # số mã gộp chung trong 1 request batch
+LATENCY_TARGET = 0.5  # giây; latency trung bình dưới ngưỡng này coi như server còn dư tải
+MAX_RETRIES = 3  # số lần thử lại mỗi batch khi bị rate limit / lỗi tạm thời
+BACKOFF_BASE = 1.0  # giây; backoff lần thử thứ k chờ tối đa BASE * 2^k
+BACKOFF_CAP = 30.0  # giây; trần thời gian chờ giữa 2 lần thử
+RPM_LIMIT = 60  # số request/phút tự giới hạn để không ép server phải trả 429
+MARKET_CLOSE_HOUR = 15  # HOSE đóng cửa 15:00; sau giờ này nến hôm nay không đổi nữa
+
+
+def backoff_delay(attempt: int) -> float:
+    """Thời gian chờ trước lần thử lại thứ `attempt` (exponential + full jitter).
+
+    Jitter ngẫu nhiên để các batch bị lỗi cùng lúc không thử lại đồng loạt
+    và dồn tải lên server đúng một nhịp.
+    """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+
 # Supabase config
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_ANON_KEY")
@@ -35,13 +61,13 @@ def load_stock_list():
         supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
         # Select distict mã cổ phiếu từ profiles
         response = supabase.table("portfolios").select("ma_cp").execute()
-        
+
         # Trích xuất danh sách duy nhất không trùng lặp
         symbols_set = set()
         for row in response.data:
             if row.get("ma_cp"):
                 symbols_set.add(row["ma_cp"].upper())
-                
+
         # Trả về list
         return list(symbols_set)
     except Exception as e:
@@ -50,29 +76,189 @@ def load_stock_list():
 
 
 
-def fetch_industry_map():
-    """Lấy bảng phân ngành ICB cho tất cả mã CP."""
-    try:
-        ls = Listing()
-        df = ls.symbols_by_industries()
-        if df is not None and not df.empty:
-            return dict(zip(df["symbol"], df["industry_name"]))
-    except Exception as e:
-        print(f"[WARN] Không lấy được phân ngành: {e}")
+class SlidingWindowLimiter:
+    """Giới hạn số request trong cửa sổ trượt 60 giây, dùng chung cho mọi worker.
+
+    Chặn TRƯỚC khi gửi nếu cửa sổ đã đầy — bổ trợ cho AIMDController, vốn chỉ
+    phản ứng SAU khi server đã trả 429.
+    """
+
+    def __init__(self, max_requests: int = RPM_LIMIT, window: float = 60.0):
+        self.max_requests = max_requests
+        self.window = window
+        self._timestamps = deque()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= self.window:
+                    self._timestamps.popleft()
+                if len(self._timestamps) < self.max_requests:
+                    self._timestamps.append(now)
+                    return
+                wait = self.window - (now - self._timestamps[0])
+            await asyncio.sleep(wait)
+
+
+class AIMDController:
+    """Điều khiển số request in-flight theo kiểu AIMD của TCP congestion control.
+
+    Tăng tuyến tính (+alpha) khi latency trung bình còn dưới LATENCY_TARGET,
+    giảm theo cấp số nhân (*beta) khi VCI trả 429/5xx. Nhờ vậy mức đồng thời
+    tự bám theo sức chịu tải thực của server thay vì một con số đoán cứng.
+    """
+
+    def __init__(self, c_min: int = 1, c_max: int = MAX_CONCURRENCY,
+                 alpha: float = 0.5, beta: float = 0.5):
+        self.c_min = c_min
+        self.c_max = c_max
+        self.alpha = alpha
+        self.beta = beta
+        self.c = (c_min + c_max) / 2  # khởi điểm giữa khoảng, AIMD tự dò lên/xuống
+        self._active = 0
+        self._cond = asyncio.Condition()
+        self._latencies = deque(maxlen=20)
+
+    async def acquire(self):
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._active < int(self.c))
+            self._active += 1
+
+    async def release(self):
+        async with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    async def record_success(self, latency: float):
+        """Ghi nhận 1 response OK; tăng thêm alpha nếu latency còn thấp."""
+        async with self._cond:
+            self._latencies.append(latency)
+            mean = sum(self._latencies) / len(self._latencies)
+            if mean <= LATENCY_TARGET:
+                self.c = min(self.c_max, self.c + self.alpha)
+                self._cond.notify_all()
+
+    async def record_throttle(self):
+        """Ghi nhận 1 lần bị 429/5xx; giảm mức đồng thời đi một nửa."""
+        async with self._cond:
+            self.c = max(self.c_min, self.c * self.beta)
+
+
+async def fetch_prices_batch(session: httpx.AsyncClient, symbols: list[str],
+                             ctrl: AIMDController,
+                             limiter: SlidingWindowLimiter) -> dict[str, tuple[float, str | None]]:
+    """Lấy giá đóng cửa mới nhất cho 1 nhóm mã trong 1 request duy nhất.
+
+    Endpoint gap-chart của VCI nhận nhiều mã cùng lúc, nên N mã chỉ tốn
+    ceil(N/CHUNK_SIZE) round-trip thay vì N.
+    Trả về {symbol: (giá VND, ngày của nến "YYYY-MM-DD")}.
+    """
+    payload = vci.history_payload(symbols)
+    for attempt in range(MAX_RETRIES):
+        try:
+            await limiter.acquire()
+            t0 = time.monotonic()
+            resp = await session.post(vci.VCI_CHART_URL, json=payload)
+            vci.check_response(resp.status_code, resp.headers)
+            resp.raise_for_status()
+            remaining = resp.headers.get("X-RateLimit-Remaining")
+            data = orjson.loads(resp.content)
+            await ctrl.record_success(time.monotonic() - t0)
+            try:
+                remaining_low = remaining is not None and int(remaining) < 2
+            except ValueError:
+                # Header không phải số: bỏ qua, đừng vứt batch đã parse xong
+                remaining_low = False
+            if remaining_low:
+                # Sắp cạn quota: chủ động bóp đồng thời trước khi server trả 429
+                await ctrl.record_throttle()
+            return vci.parse_closes(data)
+        except vci.RateLimitError as e:
+            await ctrl.record_throttle()
+            # Hết lượt thử thì khỏi chờ suông — slot đồng thời còn đang bị giữ
+            if attempt < MAX_RETRIES - 1:
+                # Server nói rõ phải chờ bao lâu — tin header, backoff khi thiếu
+                delay = e.retry_after if e.retry_after is not None else backoff_delay(attempt)
+                print(f"  [WARN] batch {symbols[0]}..{symbols[-1]}: HTTP 429, chờ {delay:.1f}s")
+                await asyncio.sleep(delay)
+        except vci.ServerError as e:
+            await ctrl.record_throttle()
+            if attempt < MAX_RETRIES - 1:
+                delay = backoff_delay(attempt)
+                print(f"  [WARN] batch {symbols[0]}..{symbols[-1]}: {e}, thử lại sau {delay:.1f}s")
+                await asyncio.sleep(delay)
+        except Exception as e:
+            if attempt < MAX_RETRIES - 1:
+                delay = backoff_delay(attempt)
+                print(f"  [ERROR] batch {symbols[0]}..{symbols[-1]}: {e} — thử lại sau {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                print(f"  [ERROR] batch {symbols[0]}..{symbols[-1]}: {e}")
+    print(f"  [ERROR] batch {symbols[0]}..{symbols[-1]}: bỏ qua sau {MAX_RETRIES} lần thử")
     return {}
 
 
-def fetch_price(symbol: str) -> tuple[str, float | None]:
-    """Lấy giá đóng cửa mới nhất của 1 mã (đơn vị VND). Trả về (symbol, price)."""
-    try:
-        quote = Quote(symbol=symbol, source='VCI')
-        df = quote.history(length="1M", interval="1D")
-        if df is not None and not df.empty:
-            raw_price = float(df["close"].iloc[-1])
-            return (symbol, raw_price * 1000)  # VCI trả giá theo đơn vị nghìn VND
-    except Exception as e:
-        print(f"  [ERROR] {symbol}: {e}")
-    return (symbol, None)
+async def fetch_all_prices(symbols: list[str], on_batch=None) -> dict[str, tuple[float, str | None]]:
+    """Fetch giá cho tất cả các mã theo batch, đồng thời trên 1 event loop.
+
+    `on_batch(prices_so_far)` (nếu có) được gọi sau mỗi batch hoàn thành,
+    dùng để flush tiến độ ra đĩa phòng khi job CI bị timeout giữa chừng.
+    """
+    ctrl = AIMDController()
+    limiter = SlidingWindowLimiter()
+
+    async def fetch_limited(session, chunk):
+        await ctrl.acquire()
+        try:
+            return await fetch_prices_batch(session, chunk, ctrl, limiter)
+        finally:
+            await ctrl.release()
+
+    # 1 client dùng chung cho cả run: HTTP/2 multiplex nhiều request trên cùng
+    # 1 kết nối TCP+TLS keep-alive, thay vì handshake lại ~150ms cho từng request
+    limits = httpx.Limits(
+        max_connections=MAX_CONCURRENCY,
+        max_keepalive_connections=MAX_CONCURRENCY,
+        keepalive_expiry=60,
+    )
+    chunks = [symbols[i:i + CHUNK_SIZE] for i in range(0, len(symbols), CHUNK_SIZE)]
+    prices = {}
+    async with httpx.AsyncClient(http2=True, limits=limits, headers=vci.VCI_HEADERS,
+                                 timeout=10.0) as session:
+        # Phân giải DNS và mở sẵn kết nối HTTP/2 trước khi các batch bắt đầu,
+        # để không batch nào phải trả phí DNS + TCP + TLS handshake.
+        # (Pin thẳng IP sẽ hỏng SNI/verify cert TLS nên warm-up là cách tương đương.)
+        try:
+            await asyncio.get_running_loop().getaddrinfo(vci.VCI_HOST, 443)
+            await session.head(f"https://{vci.VCI_HOST}/", timeout=5.0)
+        except Exception:
+            pass  # warm-up thất bại thì batch đầu tự chịu handshake
+        for fut in asyncio.as_completed([fetch_limited(session, chunk) for chunk in chunks]):
+            prices.update(await fut)
+            if on_batch is not None:
+                on_batch(prices)
+    return prices
+
+
+def write_output(prices: dict, industries: dict, dates: dict):
+    """Ghi prices.json (atomic qua file tạm). Tách riêng để flush được giữa chừng."""
+    # Schema gọn: t=updated_at, n=total_symbols, p=prices, i=industries,
+    # d=ngày của nến đang lưu. File chỉ máy đọc nên không indent.
+    output = {
+        "t": datetime.now(VN_TZ).strftime("%Y-%m-%dT%H:%M:%S+07:00"),
+        "n": len(prices),
+        "p": prices,
+        "i": industries,
+        "d": dates,
+    }
+    # Ghi atomic qua file tạm: trang HTML đọc prices.json bất cứ lúc nào,
+    # os.replace đảm bảo không bao giờ thấy file ghi dở
+    tmp_file = OUTPUT_FILE + ".tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(orjson.dumps(output))
+    os.replace(tmp_file, OUTPUT_FILE)
 
 
 def main():
@@ -89,60 +275,119 @@ def main():
     # Đọc file prices.json cũ (nếu có) để giữ giá cũ khi fetch thất bại
     old_prices = {}
     old_industries = {}
+    old_dates = {}
+    old_updated_at = ""
     if os.path.exists(OUTPUT_FILE):
         try:
-            with open(OUTPUT_FILE, "r", encoding="utf-8") as f:
-                old_data = json.load(f)
-                old_prices = old_data.get("prices", {})
-                old_industries = old_data.get("industries", {})
+            with open(OUTPUT_FILE, "rb") as f:
+                old_data = orjson.loads(f.read())
+                # Fallback key dài cho file sinh ra trước khi gọn schema
+                old_prices = old_data.get("p", old_data.get("prices", {}))
+                old_industries = old_data.get("i", old_data.get("industries", {}))
+                old_dates = old_data.get("d", old_data.get("dates", {}))
+                old_updated_at = old_data.get("t", old_data.get("updated_at", ""))
         except Exception:
             pass
 
-    # Lấy phân ngành
-    print("Đang lấy phân ngành...")
-    all_industries = fetch_industry_map()
-    # Chỉ giữ phân ngành cho các mã cần thiết
-    industries = {}
-    for sym in symbols:
-        if sym in all_industries:
-            industries[sym] = all_industries[sym]
-        elif sym in old_industries:
-            industries[sym] = old_industries[sym]
-    print(f"  → {len(industries)}/{len(symbols)} mã có phân ngành")
-
-    # Fetch giá từng mã (tuần tự, có delay để tránh rate limit)
-    print(f"Đang fetch giá cho {len(symbols)} mã...")
+    # Phân ngành ICB gần như không đổi trong ngày: nếu file cũ đã cập nhật hôm
+    # nay và phủ đủ các mã thì dùng lại, khỏi gọi Listing.
+    today = datetime.now(VN_TZ).strftime("%Y-%m-%d")
+    industries_cached = (old_updated_at.startswith(today)
+                         and all(sym in old_industries for sym in symbols))
+
+    # Sau giờ đóng cửa, nến hôm nay không đổi nữa: mã nào file cũ đã có
+    # close của hôm nay thì khỏi fetch lại. Chỉ tin file cũ nếu chính snapshot
+    # đó cũng được chụp SAU giờ đóng cửa — bản ghi trong phiên mang nến đang
+    # hình thành, close lúc đó chưa phải giá ATC cuối ngày.
+    skip = set()
+    if datetime.now(VN_TZ).hour >= MARKET_CLOSE_HOUR:
+        try:
+            old_after_close = (old_updated_at.startswith(today)
+                               and datetime.fromisoformat(old_updated_at).hour >= MARKET_CLOSE_HOUR)
+        except ValueError:
+            old_after_close = False
+        if old_after_close:
+            skip = {sym for sym in symbols if old_dates.get(sym) == today and sym in old_prices}
+    to_fetch = [sym for sym in symbols if sym not in skip]
+    if skip:
+        print(f"Bỏ qua {len(skip)} mã đã có giá đóng cửa hôm nay")
+
+    # Fetch giá theo batch (mỗi request gộp tối đa CHUNK_SIZE mã),
+    # flush tiến độ ra đĩa sau mỗi batch phòng khi job bị timeout giữa chừng
+    print(f"Đang fetch giá cho {len(to_fetch)} mã...")
+
+    # Phân ngành cũ dùng tạm cho các bản flush giữa chừng; bản ghi cuối
+    # sẽ dùng phân ngành mới (nếu phải fetch lại)
+    stale_industries = {sym: old_industries[sym] for sym in symbols if sym in old_industries}
+
+    def flush_partial(partial):
+        # Mã chưa fetch xong giữ tạm giá cũ để file luôn đầy đủ nhất có thể
+        merged_prices = {}
+        merged_dates = {}
+        for sym in symbols:
+            if sym in partial:
+                merged_prices[sym], bar_date = partial[sym]
+                if bar_date:
+                    merged_dates[sym] = bar_date
+            elif sym in old_prices:
+                merged_prices[sym] = old_prices[sym]
+                if sym in old_dates:
+                    merged_dates[sym] = old_dates[sym]
+        write_output(merged_prices, stale_industries, merged_dates)
+
+    async def fetch_everything():
+        # Pipeline: phân ngành (vnstock, blocking → chạy trong thread) song song
+        # với fetch giá, thay vì chờ xong phân ngành mới bắt đầu lấy giá
+        industry_task = None
+        if not industries_cached:
+            print("Đang lấy phân ngành...")
+            industry_task = asyncio.create_task(
+                asyncio.to_thread(vci.fetch_industry_map, symbols))
+        fetched = await fetch_all_prices(to_fetch, on_batch=flush_partial) if to_fetch else {}
+        fresh_industries = await industry_task if industry_task is not None else None
+        return fetched, fresh_industries
+
+    fetched, fresh_industries = asyncio.run(fetch_everything())
+
+    if industries_cached:
+        print("Dùng lại phân ngành đã cache hôm nay")
+        industries = {sym: old_industries[sym] for sym in symbols}
+    else:
+        industries = fresh_industries
+        for sym in symbols:
+            if sym not in industries and sym in old_industries:
+                industries[sym] = old_industries[sym]
+        print(f"  → {len(industries)}/{len(symbols)} mã có phân ngành")
+
     prices = {}
+    dates = {}
     success = 0
-    for i, sym in enumerate(symbols):
-        print(f"  [{i+1}/{len(symbols)}] {sym}...", end=" ")
-        sym_result, price = fetch_price(sym)
-        if price is not None:
+    for sym in symbols:
+        if sym in skip:
+            prices[sym] = old_prices[sym]
+            dates[sym] = old_dates[sym]
+            success += 1
+            print(f"  {sym}: = {old_prices[sym]:,.0f} VND (đã có close hôm nay)")
+            continue
+        result = fetched.get(sym)
+        if result is not None:
+            price, bar_date = result
             prices[sym] = price
+            if bar_date:
+                dates[sym] = bar_date
             success += 1
-            print(f"✓ {price:,.0f} VND")
+            print(f"  {sym}: ✓ {price:,.0f} VND")
         elif sym in old_prices:
             prices[sym] = old_prices[sym]
-            print(f"✗ (giữ giá cũ: {old_prices[sym]:,.0f} VND)")
+            if sym in old_dates:
+                dates[sym] = old_dates[sym]
+            print(f"  {sym}: ✗ (giữ giá cũ: {old_prices[sym]:,.0f} VND)")
         else:
-            print("✗ (không có giá)")
-
-        # Delay giữa các request để tránh rate limit
-        if i < len(symbols) - 1:
-            time.sleep(1)
+            print(f"  {sym}: ✗ (không có giá)")
 
     print(f"\n  → Lấy giá thành công: {success}/{len(symbols)}")
 
-    # Tạo output
-    output = {
-        "updated_at": datetime.now(VN_TZ).strftime("%Y-%m-%dT%H:%M:%S+07:00"),
-        "total_symbols": len(prices),
-        "prices": prices,
-        "industries": industries,
-    }
-
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as f:
-        json.dump(output, f, ensure_ascii=False, indent=2)
+    write_output(prices, industries, dates)
 
     print(f"=== Hoàn tất! Đã lưu {len(prices)} giá vào prices.json ===")
 
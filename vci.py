@@ -0,0 +1,107 @@
+"""
+vci.py — Phần dùng chung cho việc lấy giá từ VCI.
+
+DanhMuc.py (app Streamlit) và DanhMuc_GHPages/fetch_prices.py (GitHub Actions)
+cùng gọi endpoint gap-chart của VCI và cùng parse một kiểu response; gom về
+đây để 2 bên không trôi lệch nhau.
+"""
+
+from datetime import datetime, timezone, timedelta
+
+from vnstock import Listing
+
+VN_TZ = timezone(timedelta(hours=7))
+
+# Endpoint lịch sử giá của VCI (vnstock's Quote.history gọi chính endpoint này).
+# Gọi trực tiếp và đọc thẳng JSON, khỏi dựng DataFrame trung gian.
+VCI_HOST = "trading.vietcap.com.vn"
+VCI_CHART_URL = f"https://{VCI_HOST}/api/chart/OHLCChart/gap-chart"
+VCI_HEADERS = {
+    "Accept": "application/json",
+    "Content-Type": "application/json",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64)",
+}
+COUNT_BACK = 1  # chỉ cần nến mới nhất; gap-chart đếm lùi theo phiên nên 1 là đủ
+
+
+class VCIError(Exception):
+    """Lỗi khi gọi API VCI."""
+
+
+class RateLimitError(VCIError):
+    """VCI trả HTTP 429. `retry_after` là số giây server yêu cầu chờ (nếu có)."""
+
+    def __init__(self, retry_after: float | None = None):
+        super().__init__("HTTP 429")
+        self.retry_after = retry_after
+
+
+class ServerError(VCIError):
+    """VCI trả HTTP 5xx."""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+def check_response(status_code: int, headers) -> None:
+    """Đổi status 429/5xx thành exception có kiểu để caller except theo loại lỗi,
+    thay vì so status code (hay tệ hơn là so chuỗi message) tại chỗ."""
+    if status_code == 429:
+        retry_after = headers.get("Retry-After")
+        try:
+            # Retry-After cũng có thể là HTTP-date thay vì số giây;
+            # không parse được thì để None cho caller tự backoff
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        raise RateLimitError(retry_after)
+    if status_code >= 500:
+        raise ServerError(status_code)
+
+
+def history_payload(symbols, count_back: int = COUNT_BACK) -> dict:
+    """Body request gap-chart cho 1 nhóm mã."""
+    return {
+        "timeFrame": "ONE_DAY",
+        "symbols": list(symbols),
+        "to": int(datetime.now(VN_TZ).timestamp()),
+        "countBack": count_back,
+    }
+
+
+def parse_closes(data) -> dict[str, tuple[float, str | None]]:
+    """Đọc response gap-chart → {symbol: (giá VND, ngày nến "YYYY-MM-DD")}."""
+    prices = {}
+    for item in data or []:
+        sym = item.get("symbol")
+        if sym and item.get("c"):
+            raw_price = float(item["c"][-1])
+            ts = item.get("t") or []
+            bar_date = (datetime.fromtimestamp(int(ts[-1]), VN_TZ).strftime("%Y-%m-%d")
+                        if ts else None)
+            # VCI trả giá theo đơn vị nghìn VND (VD: 92.6 = 92,600 VND)
+            prices[sym] = (raw_price * 1000, bar_date)
+    return prices
+
+
+def fetch_industry_map(symbols=None) -> dict:
+    """Lấy bảng phân ngành ICB.
+
+    `symbols` (nếu có) lọc ngay trong lúc dựng dict, khỏi giữ bảng phân
+    ngành của cả thị trường (~1600 mã) trong bộ nhớ chỉ để tra vài mã.
+    """
+    try:
+        ls = Listing()
+        df = ls.symbols_by_industries()
+        if df is not None and not df.empty:
+            # Chỉ đụng 2 cột cần thiết, convert cả cột 1 lần bằng to_list()
+            # thay vì iterate từng dòng qua Series
+            pairs = zip(df["symbol"].to_list(), df["industry_name"].to_list())
+            if symbols is not None:
+                wanted = set(symbols)
+                return {sym: industry for sym, industry in pairs if sym in wanted}
+            return dict(pairs)
+    except Exception as e:
+        print(f"[WARN] Không lấy được phân ngành: {e}")
+    return {}